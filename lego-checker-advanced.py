@@ -1,33 +1,69 @@
 #!/usr/bin/env python3
 """
-LEGO Stock Checker - Firefox headless with anti-detection
-Uses Firefox instead of Chromium for better stealth in headless mode
+LEGO Stock Checker - Chromium headless with anti-detection
+Uses Chromium for faster startup and lower memory, with automation flags hidden
 """
 
 import asyncio
 import smtplib
 import os
-import glob
+import re
+import json
 import configparser
+from functools import lru_cache
+import aiofiles
+import aiohttp
+from bs4 import BeautifulSoup, SoupStrainer
 from email.mime.text import MIMEText
 from datetime import datetime
 from playwright.async_api import async_playwright
+from aiolimiter import AsyncLimiter
 
 CONFIG_FILE = "lego-config.ini"
 URL_FILE = "lego-urls.txt"
+ETAG_CACHE_FILE = "logs/etag-cache.json"
+STATE_FILE = "logs/state.json"
+RESULTS_FILE = "logs/results.jsonl"
+
+# Chrome UA and headers, so they agree with what Chromium reports via client hints
+CHROME_USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{version} Safari/537.36'
+USER_AGENT = CHROME_USER_AGENT.format(version='120.0.0.0')
+EXTRA_HEADERS = {
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Upgrade-Insecure-Requests': '1',
+}
+
+# Resource types the status check never reads - skip downloading them.
+# Stylesheets stay: innerText depends on CSS, so hidden status variants would leak in without them
+BLOCKED_RESOURCE_TYPES = {'image', 'media', 'font'}
+
+# Phrases the status check looks for, matched in a single pass over the page text.
+# Bare 'pre-order' comes after the longer pre-order phrases so they win when present.
+STATUS_RE = re.compile(
+    r'(retired product|no longer available|pre-order this item|pre-order today|pre-order|will ship|'
+    r'coming soon on|sold out|temporarily out of stock|backorder|available now|cloudflare|verify you are human)',
+    re.IGNORECASE
+)
+
+# Where the status text lives on the page - shared by the render wait and the text extraction
+OVERVIEW_ELEMENT_JS = "document.querySelector('[data-test=product-overview]') || document.querySelector('main') || document.body"
 
 def cleanup_temp_files():
     """Clean up old log files from the logs directory"""
     log_dir = 'logs'
     if not os.path.exists(log_dir):
         os.makedirs(log_dir)
-    for pattern in ['logs/lego_*.html', 'logs/lego_*.txt']:
-        for f in glob.glob(pattern):
-            try:
-                os.remove(f)
-            except:
-                pass
-
+    with os.scandir(log_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith('lego_') and entry.name.rpartition('.')[2] in {'html', 'txt'}:
+                try:
+                    os.unlink(entry.path)
+                except:
+                    pass
+
+@lru_cache(maxsize=1)
 def load_config():
     config = configparser.ConfigParser()
     defaults = {
@@ -37,9 +73,10 @@ def load_config():
             'from_address': 'lego-checker@localhost'
         },
         'settings': {
-            'check_delay': '15',
+            'rate': '6',
             'page_wait': '20',
-            'timeout': '60'
+            'timeout': '60',
+            'concurrency': '4'
         }
     }
     if os.path.exists(CONFIG_FILE):
@@ -48,6 +85,7 @@ def load_config():
         config.read_dict(defaults)
     return config
 
+@lru_cache(maxsize=1)
 def load_urls():
     if not os.path.exists(URL_FILE):
         return []
@@ -59,101 +97,228 @@ def load_urls():
                 urls.append((line, line_num))
         return urls
 
+def load_etag_cache():
+    if not os.path.exists(ETAG_CACHE_FILE):
+        return {}
+    try:
+        with open(ETAG_CACHE_FILE) as f:
+            return json.load(f)
+    except:
+        return {}
+
+def save_etag_cache(etag_cache):
+    try:
+        with open(ETAG_CACHE_FILE, 'w') as f:
+            json.dump(etag_cache, f, indent=2)
+    except:
+        pass
+
+@lru_cache(maxsize=None)
 def get_product_name(url):
     parts = url.rstrip('/').split('/')
     return parts[-1] if parts else url
 
-async def check_lego_status(url, page_wait=20):
-    """Simple check - just be patient"""
-
-    async with async_playwright() as p:
-        # Launch browser with stealth settings for headless mode
-        browser = await p.firefox.launch(
-            headless=True,
-            firefox_user_prefs={
-                'dom.webdriver.enabled': False,
-                'useAutomationExtension': False,
-                'general.platform.override': 'Linux x86_64',
-                'general.useragent.override': 'Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0',
-            }
-        )
-
-        # Create context with realistic settings
+async def block_heavy_resources(route):
+    if route.request.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+# One Playwright driver process per run, started on first use
+_PW = None
+_PW_LOCK = asyncio.Lock()
+
+async def get_pw():
+    global _PW
+    async with _PW_LOCK:
+        if _PW is None:
+            _PW = await async_playwright().start()
+        return _PW
+
+async def stop_pw():
+    global _PW
+    async with _PW_LOCK:
+        if _PW is not None:
+            await _PW.stop()
+            _PW = None
+
+async def launch_browser(p):
+    """Launch the shared Chromium browser and context used for every check"""
+
+    # Launch browser with stealth settings for headless mode
+    browser = await p.chromium.launch(
+        headless=True,
+        args=[
+            '--disable-blink-features=AutomationControlled',
+            '--no-sandbox',
+            '--disable-dev-shm-usage',
+        ]
+    )
+
+    # Create context with realistic settings
+    context_options = {
+        'viewport': {'width': 1920, 'height': 1080},
+        # Match the UA's major version to the Chromium actually launched
+        'user_agent': CHROME_USER_AGENT.format(version=f"{browser.version.split('.')[0]}.0.0.0"),
+        'locale': 'en-US',
+        'timezone_id': 'America/New_York',
+    }
+    # Reuse cookies from the last run so Cloudflare clearance carries over
+    try:
         context = await browser.new_context(
-            viewport={'width': 1920, 'height': 1080},
-            user_agent='Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0',
-            locale='en-US',
-            timezone_id='America/New_York',
+            storage_state=STATE_FILE if os.path.exists(STATE_FILE) else None,
+            **context_options
         )
+    except:
+        context = await browser.new_context(**context_options)
+
+    # Add extra headers
+    await context.set_extra_http_headers(EXTRA_HEADERS)
+
+    # Hide navigator.webdriver from page scripts
+    await context.add_init_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined});")
+
+    # Images, media and fonts are where the bytes are and don't affect the status text
+    await context.route('**/*', block_heavy_resources)
+
+    return browser, context
+
+def find_indicators(text):
+    """Return the set of status phrases present in page text"""
+    return {m.group(1).lower() for m in STATUS_RE.finditer(text)}
+
+def detect_status(found):
+    """Map the status phrases found in page text to a status"""
+
+    # Check if blocked
+    if 'cloudflare' in found or 'verify you are human' in found:
+        return 'BLOCKED'
+
+    # Check in priority order (most specific patterns first)
+    if 'retired product' in found or 'no longer available' in found:
+        return 'RETIRED'
+    elif 'pre-order this item' in found or 'pre-order today' in found or ('pre-order' in found and 'will ship' in found):
+        return 'PRE_ORDER'
+    elif 'coming soon on' in found and 'pre-order' not in found:
+        return 'COMING_SOON'
+    elif 'sold out' in found:
+        return 'SOLD_OUT'
+    elif 'temporarily out of stock' in found:
+        return 'TEMP_OUT'
+    elif 'backorder' in found:
+        return 'BACKORDER'
+    elif 'available now' in found:
+        return 'AVAILABLE'
+    else:
+        return 'UNKNOWN'
+
+def extract_overview(html):
+    """Return the product overview text and page title from raw HTML"""
+    # Only build the overview subtree - full product pages are often over 1 MB
+    soup = BeautifulSoup(html, 'html.parser', parse_only=SoupStrainer(attrs={'data-test': 'product-overview'}))
+    overview = soup.select_one('[data-test=product-overview]')
+    if overview is None:
+        return None, None
+    for tag in overview(['script', 'style']):
+        tag.decompose()
+
+    match = re.search(r'<title[^>]*>(.*?)</title>', html, re.IGNORECASE | re.DOTALL)
+    title = match.group(1).strip() if match else None
+    return overview.get_text(' ', strip=True)[:20000], title
+
+async def fast_check(session, limiter, url, etag_cache):
+    """Try the server-rendered HTML first - returns UNKNOWN if a browser is needed"""
+
+    cached = etag_cache.get(url, {})
+    headers = {}
+    if cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+    if cached.get('last_modified'):
+        headers['If-Modified-Since'] = cached['last_modified']
 
-        # Add extra headers
-        await context.set_extra_http_headers({
-            'Accept-Language': 'en-US,en;q=0.9',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-        })
+    try:
+        async with limiter:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304 and cached.get('status'):
+                    return cached['status'], cached.get('title'), set(cached.get('indicators', []))
+                if response.status != 200:
+                    return 'UNKNOWN', None, set()
+                html = await response.text()
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+    except:
+        return 'UNKNOWN', None, set()
 
-        page = await context.new_page()
+    # Only read the product overview, same as the browser path - other cards on
+    # the page can say "Sold out" too. No overview in the SSR HTML means a browser is needed.
+    # Parsing is pure Python, so keep it off the event loop.
+    try:
+        overview_text, title = await asyncio.to_thread(extract_overview, html)
+    except:
+        return 'UNKNOWN', None, set()
+    if overview_text is None:
+        return 'UNKNOWN', None, set()
+
+    # A challenge page or missing status text needs the full browser
+    found = find_indicators(overview_text)
+    status = detect_status(found)
+    if status in ('UNKNOWN', 'BLOCKED'):
+        return 'UNKNOWN', None, set()
+
+    etag_cache[url] = {
+        'etag': etag,
+        'last_modified': last_modified,
+        'status': status,
+        'title': title,
+        'indicators': sorted(found),
+    }
+    return status, title, found
 
-        try:
-            print(f"    Loading...")
-            await page.goto(url, timeout=60000, wait_until='domcontentloaded')
+async def check_lego_status(page, limiter, url, page_wait=20):
+    """Simple check - just be patient"""
 
-            print(f"    Waiting {page_wait}s for content...")
-            await page.wait_for_timeout(page_wait * 1000)
+    try:
+        async with limiter:
+            # networkidle often never settles on busy retail pages - the status wait below covers rendering
+            await page.goto(url, timeout=60000, wait_until='domcontentloaded')
 
-            body_text = await page.inner_text('body')
-            title = await page.title()
+        # Stop waiting as soon as the product area shows a phrase STATUS_RE knows
+        try:
+            await page.wait_for_function(
+                f"(pattern) => {{ const el = {OVERVIEW_ELEMENT_JS}; return !!el && new RegExp(pattern, 'i').test(el.innerText); }}",
+                arg=STATUS_RE.pattern,
+                polling=250,
+                timeout=page_wait * 1000
+            )
+        except:
+            pass
+
+        # Pull only the product area's text out of the page, capped there so Python never sees the full body
+        body_text = await page.evaluate(
+            f"() => {{ const el = {OVERVIEW_ELEMENT_JS}; return el.innerText.slice(0, 20000); }}"
+        )
+        title = await page.title()
 
+        # Per-page dumps are only kept when debugging - results go to RESULTS_FILE
+        if os.environ.get('LEGO_DEBUG'):
             product_name = get_product_name(url)
             html = await page.content()
-            with open(f'logs/lego_{product_name}.html', 'w') as f:
-                f.write(html)
-            with open(f'logs/lego_{product_name}.txt', 'w') as f:
-                f.write(f"Title: {title}\n\n{body_text[:10000]}")
-
-            await context.close()
-            await browser.close()
-
-            # Check if blocked
-            if 'cloudflare' in body_text.lower() or 'verify you are human' in body_text.lower():
-                return 'BLOCKED', None, None
-
-            # Check status - look for specific patterns
-            text_lower = body_text.lower()
-
-            # Check in priority order (most specific patterns first)
-            if 'retired product' in text_lower or 'no longer available' in text_lower:
-                status = 'RETIRED'
-            elif 'pre-order this item' in text_lower or 'pre-order today' in text_lower or ('pre-order' in text_lower and 'will ship' in text_lower):
-                status = 'PRE_ORDER'
-            elif 'coming soon on' in text_lower and 'pre-order' not in text_lower:
-                status = 'COMING_SOON'
-            elif 'sold out' in text_lower:
-                status = 'SOLD_OUT'
-            elif 'temporarily out of stock' in text_lower:
-                status = 'TEMP_OUT'
-            elif 'backorder' in text_lower:
-                status = 'BACKORDER'
-            elif 'available now' in text_lower:
-                status = 'AVAILABLE'
-            else:
-                status = 'UNKNOWN'
-
-            return status, title, None
-
-        except Exception as e:
-            try:
-                await context.close()
-                await browser.close()
-            except:
-                pass
-            return None, None, str(e)
+            async with aiofiles.open(f'logs/lego_{product_name}.html', 'w') as f:
+                await f.write(html)
+            async with aiofiles.open(f'logs/lego_{product_name}.txt', 'w') as f:
+                await f.writelines(("Title: ", title, "\n\n", body_text))
+
+        found = find_indicators(body_text)
+        status = detect_status(found)
+        if status == 'BLOCKED':
+            return 'BLOCKED', None, found, None
 
-def send_email(config, subject, body):
+        return status, title, found, None
+
+    except Exception as e:
+        return None, None, set(), str(e)
+
+def send_email(smtp, config, subject, body):
     recipient = config['email']['recipient']
     smtp_server = config['email']['smtp_server']
     from_addr = config['email']['from_address']
@@ -165,8 +330,16 @@ def send_email(config, subject, body):
 
 
     try:
-        with smtplib.SMTP(smtp_server) as smtp:
-            smtp.send_message(msg)
+        # A connection that has already sent mail may have been dropped by the
+        # server - check it and reconnect. Fresh connections skip the round trip.
+        if smtp.ehlo_resp or smtp.helo_resp:
+            try:
+                smtp.noop()
+            except smtplib.SMTPServerDisconnected:
+                # close() keeps the old EHLO reply, so clear it or send_message skips EHLO
+                smtp.ehlo_resp = smtp.helo_resp = None
+                smtp.connect(smtp_server)
+        smtp.send_message(msg)
         return True
     except:
         return False
@@ -181,55 +354,130 @@ async def main():
         print(f"No URLs. Add to {URL_FILE}")
         return
 
-    delay = int(config['settings']['check_delay'])
+    rate = float(config['settings'].get('rate', '6'))
     page_wait = int(config['settings']['page_wait'])
+    timeout = int(config['settings']['timeout'])
+    concurrency = int(config['settings'].get('concurrency', '4'))
 
     print(f"LEGO Checker - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    print(f"Checking {len(urls)} products (patient mode)")
+    print(f"Checking {len(urls)} products ({concurrency} at a time)")
     print("=" * 70)
 
-    results = []
+    etag_cache = load_etag_cache()
 
-    for url, line_num in urls:
-        product_name = get_product_name(url)
-        print(f"\n[{line_num}] {product_name}")
+    # aiohttp negotiates its own compression, so leave Accept-Encoding to it
+    http_headers = {k: v for k, v in EXTRA_HEADERS.items() if k != 'Accept-Encoding'}
+    http_headers['User-Agent'] = USER_AGENT
+
+    # Cap page loads per minute so bursts don't trip Cloudflare
+    limiter = AsyncLimiter(max_rate=rate, time_period=60)
+    results = [None] * len(urls)
 
-        status, title, error = await check_lego_status(url, page_wait)
+    def record(index, url, line_num, status, title, indicators, error=None):
+        product_name = get_product_name(url)
 
+        print(f"\n[{line_num}] {product_name}")
         if error:
             print(f"    ERROR: {error}")
-            results.append({
-                'line_num': line_num,
-                'product_name': product_name,
-                'url': url,
-                'status': 'ERROR',
-                'error': error
-            })
+            status = 'ERROR'
         elif status == 'BLOCKED':
-            print(f"    BLOCKED: Cloudflare blocked - check logs/lego_{product_name}.txt")
-            results.append({
-                'line_num': line_num,
-                'product_name': product_name,
-                'url': url,
-                'status': 'BLOCKED',
-                'error': None
-            })
+            print(f"    BLOCKED: Cloudflare blocked - see {RESULTS_FILE}")
         else:
             print(f"    STATUS: {status}")
-            results.append({
-                'line_num': line_num,
-                'product_name': product_name,
-                'url': url,
-                'status': status,
-                'title': title,
-                'error': None
-            })
 
-        await asyncio.sleep(delay)
+        results[index] = {
+            'line_num': line_num,
+            'product_name': product_name,
+            'url': url,
+            'status': status,
+            'title': title,
+            'indicators': sorted(indicators),
+            'error': error
+        }
 
+    async with aiohttp.ClientSession(
+        headers=http_headers,
+        connector=aiohttp.TCPConnector(limit_per_host=4),
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    ) as session:
+        # Settle whatever the server-rendered HTML can before touching a browser
+        fast_results = await asyncio.gather(*[fast_check(session, limiter, url, etag_cache) for url, _ in urls])
+
+    pending = []
+    for index, ((url, line_num), (status, title, indicators)) in enumerate(zip(urls, fast_results)):
+        if status == 'UNKNOWN':
+            pending.append((index, url, line_num))
+        else:
+            record(index, url, line_num, status, title, indicators)
+
+    if pending:
+        try:
+            browser, context = await launch_browser(await get_pw())
+
+            queue = asyncio.Queue()
+            for item in pending:
+                queue.put_nowait(item)
+
+            async def worker():
+                # Each worker keeps one page warm and navigates it from URL to URL,
+                # opening it on the first URL it takes
+                page = None
+                replace_page = False
+                while True:
+                    try:
+                        index, url, line_num = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    if page is None:
+                        page = await context.new_page()
+                    elif replace_page or page.is_closed():
+                        try:
+                            await page.close()
+                        except:
+                            pass
+                        page = await context.new_page()
+                    status, title, indicators, error = await check_lego_status(page, limiter, url, page_wait)
+                    record(index, url, line_num, status, title, indicators, error)
+                    # A crashed renderer doesn't report as closed, so start the
+                    # next URL on a fresh page after any error
+                    replace_page = error is not None
+
+            try:
+                await asyncio.gather(*[worker() for _ in range(min(concurrency, len(pending)))])
+
+                # Keep the cookies for next time, but only if a browser check actually
+                # got past Cloudflare to a real status - fast-path results prove nothing
+                if any(results[index]['status'] not in ('ERROR', 'BLOCKED', 'UNKNOWN') for index, _, _ in pending):
+                    try:
+                        await context.storage_state(path=STATE_FILE)
+                    except:
+                        pass
+            finally:
+                await context.close()
+                await browser.close()
+        finally:
+            # Always stop the driver, even if launching or closing the browser failed
+            await stop_pw()
+
+    save_etag_cache(etag_cache)
+
+    # One append-only record per check instead of a set of files per URL
+    timestamp = datetime.now().isoformat(timespec='seconds')
+    async with aiofiles.open(RESULTS_FILE, 'a') as out:
+        await out.writelines(
+            json.dumps({
+                'ts': timestamp,
+                'url': result['url'],
+                'status': result['status'],
+                'title': result['title'],
+                'indicators': result['indicators'],
+                'error': result['error'],
+            }) + "\n"
+            for result in results
+        )
 
     print("\n" + "=" * 70)
-    print("Check logs/lego_*.txt to see what was extracted")
+    print(f"Results appended to {RESULTS_FILE}")
 
     # Send one summary email with all results
     summary_lines = [f"LEGO Stock Check - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", ""]
@@ -242,7 +490,13 @@ async def main():
         summary_lines.append("")
 
     summary_body = "\n".join(summary_lines)
-    if send_email(config, "LEGO Stock Check Summary", summary_body):
+    try:
+        # One connection for every message sent this run
+        with smtplib.SMTP(config['email']['smtp_server']) as smtp:
+            sent = send_email(smtp, config, "LEGO Stock Check Summary", summary_body)
+    except:
+        sent = False
+    if sent:
         print("\nSummary email sent")
 
 if __name__ == '__main__':
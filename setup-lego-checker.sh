@@ -11,6 +11,23 @@ sudo apt install -y python3-bs4
 echo "Installing cloudscraper..."
 pip3 install cloudscraper --break-system-packages
 
+# Install Playwright and the Chromium browser it drives
+echo "Installing playwright..."
+pip3 install playwright --break-system-packages
+python3 -m playwright install chromium
+
+# Install aiolimiter (request rate limiting)
+echo "Installing aiolimiter..."
+pip3 install aiolimiter --break-system-packages
+
+# Install aiofiles (non-blocking log writes)
+echo "Installing aiofiles..."
+pip3 install aiofiles --break-system-packages
+
+# Install aiohttp (fast path before launching a browser)
+echo "Installing aiohttp..."
+pip3 install aiohttp --break-system-packages
+
 # Create config file if it doesn't exist
 if [ ! -f lego-config.ini ]; then
     cat > lego-config.ini << 'CONFIGEOF'
@@ -20,7 +37,7 @@ smtp_server = localhost
 from_address = lego-checker@localhost
 
 [settings]
-check_delay = 3
+rate = 6
 timeout = 30
 CONFIGEOF
     echo "✓ Created lego-config.ini"
@@ -50,7 +67,7 @@ chmod +x lego-checker-advanced.py
 # Test modules
 echo ""
 echo "Testing Python modules..."
-if python3 -c "import cloudscraper; import bs4; print('✓ All modules available')" 2>/dev/null; then
+if python3 -c "import cloudscraper; import bs4; import aiolimiter; import aiofiles; import aiohttp; print('✓ All modules available')" 2>/dev/null; then
     echo "✓ Dependencies OK"
 else
     echo "✗ Missing dependencies"